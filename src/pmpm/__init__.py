@@ -4,20 +4,29 @@
 import logging
 import os
 
-try:
-    from coloredlogs import ColoredFormatter as Formatter
-except ImportError:
-    from logging import Formatter
-
 __version__ = "0.2.0"
 
 logger = logging.getLogger(__name__)
-handler = logging.StreamHandler()
-logger.addHandler(handler)
-handler.setFormatter(Formatter("%(name)s %(levelname)s (%(module)-s): %(message)s"))
-try:
-    level = os.environ.get("PMPMLOGLEVEL", logging.INFO)
-    logger.setLevel(level=level)
-except ValueError:
-    logger.setLevel(level=logging.INFO)
-    logger.error("Unknown PMPMLOGLEVEL %s, set to default INFO.", level)
+
+
+def _configure_logging() -> None:
+    """Configure the pmpm logger for the command line interfaces.
+
+    `coloredlogs` is imported here rather than at module level to keep `import pmpm` cheap.
+    """
+    if logger.handlers:
+        return
+    try:
+        from coloredlogs import ColoredFormatter as Formatter
+    except ImportError:
+        from logging import Formatter
+
+    handler = logging.StreamHandler()
+    logger.addHandler(handler)
+    handler.setFormatter(Formatter("%(name)s %(levelname)s (%(module)-s): %(message)s"))
+    try:
+        level = os.environ.get("PMPMLOGLEVEL", logging.INFO)
+        logger.setLevel(level=level)
+    except ValueError:
+        logger.setLevel(level=logging.INFO)
+        logger.error("Unknown PMPMLOGLEVEL %s, set to default INFO.", level)
@@ -7,23 +7,36 @@ as well as its main logic.
 from __future__ import annotations
 
 import os
-import platform
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
 from dataclasses import dataclass, field
-from functools import cached_property
+from functools import lru_cache
 from importlib import import_module
 from logging import getLogger
+from operator import attrgetter
 from pathlib import Path
-from typing import TYPE_CHECKING, ClassVar
+from typing import TYPE_CHECKING, Any, Callable, ClassVar
 
-import defopt
-import psutil
-import yaml
 from custom_inherit import DocInheritMeta
 
 from .packages.conda import Package as CondaPackage
-from .util import append_env, append_path, check_dir, check_file, prepend_path, split_conda_dep_from_pip
+from .util import (
+    _invalidate_stat_cache,
+    append_env,
+    append_path,
+    cached_property,
+    cgroup_cpu_quota,
+    check_dir,
+    check_file,
+    physical_cpu_count,
+    prepend_path,
+    split_conda_dep_from_pip,
+)
 
 if TYPE_CHECKING:
+    from types import ModuleType
+
     PMPM_DICT_SPEC = dict[
         str,
         list[str] | str | bool | None,
@@ -35,6 +48,48 @@ if TYPE_CHECKING:
 
 logger = getLogger("pmpm")
 
+# same as platform.system() on supported systems, without importing platform
+_SYSTEM = (
+    "Linux" if sys.platform.startswith("linux") else "Darwin" if sys.platform == "darwin" else sys.platform.title()
+)
+
+
+@lru_cache(maxsize=32)
+def _load_yaml_cached(path: str, mtime_ns: int, size: int) -> dict[str, Any]:
+    """Load a YAML file, cached by its path, modification time and size.
+
+    `mtime_ns` and `size` are not used in the body but are part of the cache key,
+    such that the cache is invalidated when the file is modified.
+    """
+    import yaml
+
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader  # type: ignore[assignment]
+
+    with open(path) as f:
+        return yaml.load(f, Loader=SafeLoader)
+
+
+@lru_cache(maxsize=1)
+def _base_environ() -> dict[str, str]:
+    """Return a snapshot of the environment variables, taken once per process.
+
+    CONDA_PREFIX is pointed to the root prefix and the mamba banner is disabled. The result is shared and must not be mutated.
+    """
+    _dict = dict(os.environ)
+    conda_bin = Path(_dict["CONDA_EXE"])
+    _dict["CONDA_PREFIX"] = str(conda_bin.parent.parent)
+    _dict.setdefault("MAMBA_NO_BANNER", "1")
+    return _dict
+
+
+@lru_cache(maxsize=None)
+def _load_package_module(dep: str) -> ModuleType:
+    """Import the module defining the package `dep` in `pmpm.packages`."""
+    return import_module(f".packages.{dep}", package="pmpm")
+
 
 @dataclass
 class InstallEnvironment(metaclass=DocInheritMeta(style="google_with_merge")):  # type: ignore[misc]
@@ -60,6 +115,12 @@ class InstallEnvironment(metaclass=DocInheritMeta(style="google_with_merge")):
         update: if updating all packages. If neither --update nor --no-update is provided, determine automatically.
         arch: -march for compilation, for example, native or x86-64-v3
         tune: -mtune for compilation, for example, native or generic
+        conda_lockfile: an explicit conda lockfile, such as from `conda list --explicit`.
+            If provided, the conda environment is created/updated from it without solving,
+            and `conda_channels` and `conda_dependencies` are ignored.
+        pgo: build compiled packages that support it with profile-guided optimization,
+            using their tests as the training run. This roughly doubles the build time.
+        lto: build compiled packages that support it with link-time optimization.
     """
 
     prefix: Path
@@ -84,16 +145,42 @@ class InstallEnvironment(metaclass=DocInheritMeta(style="google_with_merge")):
     arch: str = "x86-64-v3"
     # for example, native or generic
     tune: str = "generic"
+    conda_lockfile: Path | None = None
+    pgo: bool = False
+    lto: bool = False
     conda_environment_filename: ClassVar[str] = "environment.yml"
-    supported_systems: ClassVar[tuple[str, ...]] = ("Linux", "Darwin")
-    system: ClassVar[str] = platform.system()
-    cpu_count: ClassVar[int] = psutil.cpu_count(logical=False)
+    supported_systems: ClassVar[frozenset[str]] = frozenset(("Linux", "Darwin"))
+    system: ClassVar[str] = _SYSTEM
+    max_download_workers: ClassVar[int] = 4
+    is_linux: ClassVar[bool] = _SYSTEM == "Linux"
+    is_darwin: ClassVar[bool] = _SYSTEM == "Darwin"
+    # fields serialized under the _pmpm key of the YAML file
+    pmpm_fields: ClassVar[tuple[str, ...]] = (
+        "dependencies",
+        "python_version",
+        "conda_prefix_name",
+        "compile_prefix_name",
+        "download_prefix_name",
+        "conda",
+        "sub_platform",
+        "skip_test",
+        "skip_conda",
+        "fast_update",
+        "update",
+        "arch",
+        "tune",
+        "conda_lockfile",
+        "pgo",
+        "lto",
+    )
+    _pmpm_getter: ClassVar[Callable[[Any], tuple[Any, ...]]] = attrgetter(*pmpm_fields)
 
     def __post_init__(self) -> None:
         if self.file is not None:
             logger.info("Reading environment definition from %s and overriding cli options", self.file)
-            with self.file.open() as f:
-                data = yaml.safe_load(f)
+            stat = self.file.stat()
+            # deepcopy as the cached data should not be mutated by the instance
+            data = deepcopy(_load_yaml_cached(str(self.file), stat.st_mtime_ns, stat.st_size))
             if "channels" in data:
                 self.conda_channels = data["channels"]
             if "dependencies" in data:
@@ -102,38 +189,18 @@ class InstallEnvironment(metaclass=DocInheritMeta(style="google_with_merge")):
                     self.pip_dependencies = pip_dependencies
             if "prefix" in data:
                 self.prefix = Path(data["prefix"])
-            if "_pmpm" in data:
-                pmpm = data["_pmpm"]
-                if "dependencies" in pmpm:
-                    self.dependencies = pmpm["dependencies"]
-                if "python_version" in pmpm:
-                    self.python_version = str(pmpm["python_version"])
-                if "conda_prefix_name" in pmpm:
-                    self.conda_prefix_name = pmpm["conda_prefix_name"]
-                if "compile_prefix_name" in pmpm:
-                    self.compile_prefix_name = pmpm["compile_prefix_name"]
-                if "download_prefix_name" in pmpm:
-                    self.download_prefix_name = pmpm["download_prefix_name"]
-                if "conda" in pmpm:
-                    self.conda = pmpm["conda"]
-                if "sub_platform" in pmpm:
-                    self.sub_platform = pmpm["sub_platform"]
-                if "skip_test" in pmpm:
-                    self.skip_test = pmpm["skip_test"]
-                if "skip_conda" in pmpm:
-                    self.skip_conda = pmpm["skip_conda"]
-                if "fast_update" in pmpm:
-                    self.fast_update = pmpm["fast_update"]
-                if "update" in pmpm:
-                    self.update = pmpm["update"]
-                if "arch" in pmpm:
-                    self.arch = pmpm["arch"]
-                if "tune" in pmpm:
-                    self.tune = pmpm["tune"]
+            pmpm = data.get("_pmpm", {})
+            for key in self.pmpm_fields:
+                if key in pmpm:
+                    setattr(self, key, pmpm[key])
+            self.python_version = str(self.python_version)
+            if self.conda_lockfile is not None:
+                self.conda_lockfile = Path(self.conda_lockfile)
         if self.system not in self.supported_systems:
             raise OSError(f"OS {self.system} not supported.")
 
-        append_env(self.conda_dependencies, f"python={self.python_version}")
+        self._conda_dependencies_set = set(self.conda_dependencies)
+        append_env(self.conda_dependencies, self._conda_dependencies_set, f"python={self.python_version}")
 
     @property
     def name(self) -> str:
@@ -145,82 +212,84 @@ class InstallEnvironment(metaclass=DocInheritMeta(style="google_with_merge")):
         """Return a dictionary of dependencies with version."""
         res: dict[str, str | None] = {}
         for dep in self.dependencies:
-            temp = dep.split("=")
-            if len(temp) == 1:
-                res[temp[0]] = None
-            elif len(temp) == 2:
-                res[temp[0]] = temp[1]
-            else:
+            name, sep, version = dep.partition("=")
+            if "=" in version:
                 raise RuntimeError(f"Invalid dependency {dep}")
+            res[name] = version if sep else None
         return res
 
-    @property
+    @cached_property
     def to_dict(
         self,
     ) -> PMPM_YAML_SPEC:
-        """Return a dictionary representation of the environment."""
+        """Return a dictionary representation of the environment.
+
+        This is cached, so fields should not be mutated after it is first accessed.
+        """
         conda_dependencies: list[str] | list[str | dict[str, list[str]]] = (
             self.conda_dependencies + [{"pip": self.pip_dependencies}]
             if self.pip_dependencies
             else self.conda_dependencies
         )
+        pmpm = dict(zip(self.pmpm_fields, type(self)._pmpm_getter(self)))
+        if self.conda_lockfile is not None:
+            pmpm["conda_lockfile"] = str(self.conda_lockfile)
         return {
             "name": self.name,
             "channels": self.conda_channels,
             "dependencies": conda_dependencies,
             "prefix": str(self.prefix),
-            "_pmpm": {
-                "dependencies": self.dependencies,
-                "python_version": self.python_version,
-                "conda_prefix_name": self.conda_prefix_name,
-                "compile_prefix_name": self.compile_prefix_name,
-                "download_prefix_name": self.download_prefix_name,
-                "conda": self.conda,
-                "sub_platform": self.sub_platform,
-                "skip_test": self.skip_test,
-                "skip_conda": self.skip_conda,
-                "fast_update": self.fast_update,
-                "update": self.update,
-                "arch": self.arch,
-                "tune": self.tune,
-            },
+            "_pmpm": pmpm,
         }
 
     def write_dict(self) -> None:
-        """Write the environment definition to a YAML file."""
-        logger.info("Writing environment definition to %s", self.conda_environment_path)
+        """Write the environment definition to a YAML file.
+
+        The file is not touched if its content is unchanged.
+        """
+        import yaml
+
+        try:
+            from yaml import CSafeDumper as SafeDumper
+        except ImportError:
+            from yaml import SafeDumper  # type: ignore[assignment]
+
+        content = yaml.dump(
+            self.to_dict,
+            Dumper=SafeDumper,
+            default_flow_style=False,
+        )
         conda_environment_path = self.conda_environment_path
+        try:
+            existing: str | None = conda_environment_path.read_text()
+        except FileNotFoundError:
+            existing = None
+        if content == existing:
+            logger.debug("Environment definition at %s unchanged, skip writing.", conda_environment_path)
+            return
+        logger.info("Writing environment definition to %s", conda_environment_path)
         conda_environment_path.parent.mkdir(parents=True, exist_ok=True)
-        with conda_environment_path.open("w") as f:
-            yaml.safe_dump(
-                self.to_dict,
-                f,
-                default_flow_style=False,
-            )
+        conda_environment_path.write_text(content)
 
     @classmethod
     def from_dict(cls, data: PMPM_YAML_SPEC) -> InstallEnvironment:
-        """Construct an environment from a dictionary."""
-        pmpm: dict[str, PMPM_DICT_SPEC] = data["_pmpm"]  # type: ignore[assignment]
-        conda_dependencies, pip_dependencies = split_conda_dep_from_pip(data["dependencies"])  # type: ignore[arg-type]
+        """Construct an environment from a dictionary.
+
+        Only `prefix` is required, other missing keys fall back to the defaults.
+        """
+        pmpm: dict[str, PMPM_DICT_SPEC] = data.get("_pmpm", {})  # type: ignore[assignment]
+        conda_dependencies, pip_dependencies = split_conda_dep_from_pip(data.get("dependencies", []))  # type: ignore[arg-type]
+        kwargs: dict[str, Any] = {key: pmpm[key] for key in cls.pmpm_fields if key in pmpm}
+        if "python_version" in kwargs:
+            kwargs["python_version"] = str(kwargs["python_version"])
+        if kwargs.get("conda_lockfile") is not None:
+            kwargs["conda_lockfile"] = Path(kwargs["conda_lockfile"])
         return cls(
             Path(data["prefix"]),  # type: ignore[arg-type]
-            conda_channels=data["channels"],  # type: ignore[arg-type]
+            conda_channels=data.get("channels", []),  # type: ignore[arg-type]
             conda_dependencies=conda_dependencies,
             pip_dependencies=pip_dependencies,
-            dependencies=pmpm["dependencies"],  # type: ignore[arg-type]
-            python_version=str(pmpm["python_version"]),
-            conda_prefix_name=pmpm["conda_prefix_name"],  # type: ignore[arg-type]
-            compile_prefix_name=pmpm["compile_prefix_name"],  # type: ignore[arg-type]
-            download_prefix_name=pmpm["download_prefix_name"],  # type: ignore[arg-type]
-            conda=pmpm["conda"],  # type: ignore[arg-type]
-            sub_platform=pmpm["sub_platform"],  # type: ignore[arg-type]
-            skip_test=pmpm["skip_test"],  # type: ignore[arg-type]
-            skip_conda=pmpm["skip_conda"],  # type: ignore[arg-type]
-            fast_update=pmpm["fast_update"],  # type: ignore[arg-type]
-            update=pmpm["update"],  # type: ignore[arg-type]
-            arch=pmpm["arch"],  # type: ignore[arg-type]
-            tune=pmpm["tune"],  # type: ignore[arg-type]
+            **kwargs,
         )
 
     @cached_property
@@ -229,14 +298,18 @@ class InstallEnvironment(metaclass=DocInheritMeta(style="google_with_merge")):
         return self.prefix / self.conda_environment_filename
 
     @cached_property
-    def is_linux(self) -> bool:
-        """Return True if the system is Linux."""
-        return self.system == "Linux"
-
-    @cached_property
-    def is_darwin(self) -> bool:
-        """Return True if the system is macOS."""
-        return self.system == "Darwin"
+    def cpu_count(self) -> int:
+        """Return the number of physical CPU cores available to this process.
+
+        Fall back to the number of logical CPUs if it cannot be determined,
+        and cap it by the CPU quota of the cgroup, such as in containers.
+        """
+        count = physical_cpu_count()
+        if count is None:
+            count = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+        if (quota := cgroup_cpu_quota()) is not None:
+            count = min(count, quota)
+        return count
 
     @cached_property
     def conda_bin(self) -> Path:
@@ -266,56 +339,79 @@ class InstallEnvironment(metaclass=DocInheritMeta(style="google_with_merge")):
     @cached_property
     def conda_prefix(self) -> Path:
         """Path to the prefix for conda."""
-        path = self.prefix / self.conda_prefix_name
-        path.mkdir(parents=True, exist_ok=True)
-        return path
+        return self.prefix / self.conda_prefix_name
 
     @cached_property
     def compile_prefix(self) -> Path:
         """Path to the prefix for the compiled stack by pmpm."""
-        path = self.prefix / self.compile_prefix_name
-        path.mkdir(parents=True, exist_ok=True)
-        return path
+        return self.prefix / self.compile_prefix_name
 
     @cached_property
     def downoad_prefix(self) -> Path:
         """Path to the prefix for the downloaded source codes by pmpm."""
-        path = self.prefix / self.download_prefix_name
-        path.mkdir(parents=True, exist_ok=True)
-        return path
+        return self.prefix / self.download_prefix_name
+
+    @cached_property
+    def _compile_prefix_bin(self) -> str:
+        """The bin directory of the compile prefix as a string."""
+        return os.fspath(self.compile_prefix / "bin")
+
+    @cached_property
+    def _conda_prefix_bin(self) -> str:
+        """The bin directory of the conda prefix as a string."""
+        return os.fspath(self.conda_prefix / "bin")
+
+    @cached_property
+    def ccache_dir(self) -> Path:
+        """Path to the ccache directory, which persists across package reinstalls."""
+        return self.compile_prefix / ".ccache"
 
     @cached_property
     def environ(self) -> dict[str, str]:
         """Return a dictionary of environment variables."""
-        _dict = dict(os.environ)
-        # point CONDA_PREFIX to the root prefix
-        conda_bin = Path(_dict["CONDA_EXE"])
-        _dict["CONDA_PREFIX"] = str(conda_bin.parent.parent)
-        return _dict
+        env = _base_environ().copy()
+        env.setdefault("CCACHE_DIR", os.fspath(self.ccache_dir))
+        return env
 
     @cached_property
     def environ_with_compile_path(self) -> dict[str, str]:
         """Return a dictionary of environment variables with compile prefix prepended to PATH."""
         env = self.environ.copy()
-        prepend_path(env, str(self.compile_prefix / "bin"))
+        prepend_path(env, self._compile_prefix_bin)
         return env
 
     @cached_property
     def environ_with_conda_path(self) -> dict[str, str]:
         """Return a dictionary of environment variables with conda prefix prepended to PATH."""
         env = self.environ.copy()
-        prepend_path(env, str(self.conda_prefix / "bin"))
+        prepend_path(env, self._conda_prefix_bin)
         return env
 
     @cached_property
     def environ_with_all_paths(self) -> dict[str, str]:
         """Return a dictionary of environment variables with all prefixes prepended to PATH."""
-        env = self.environ_with_compile_path.copy()
-        prepend_path(env, str(self.conda_prefix / "bin"))
+        env = self.environ.copy()
+        prepend_path(env, f"{self._conda_prefix_bin}{os.pathsep}{self._compile_prefix_bin}")
         return env
 
+    def _ensure_prefixes(self) -> None:
+        """Create the conda, compile and download prefixes if not exist."""
+        for path in (self.conda_prefix, self.compile_prefix, self.downoad_prefix):
+            path.mkdir(parents=True, exist_ok=True)
+
     def run_all(self) -> None:
         """Run all steps to install/update the environment."""
+        _invalidate_stat_cache()
+
+        # resolve all packages before installing anything to fail early
+        package_classes = {}
+        for dep in self.dependencies_versioned:
+            try:
+                package_classes[dep] = _load_package_module(dep).Package
+            except ImportError as e:
+                raise RuntimeError(f"Package {dep} is not defined in pmpm.packages.{dep}") from e
+
+        self._ensure_prefixes()
         self.write_dict()
 
         # install conda
@@ -328,12 +424,8 @@ class InstallEnvironment(metaclass=DocInheritMeta(style="google_with_merge")):
             )
             package.run_all()
 
-        for dep, ver in self.dependencies_versioned.items():
-            try:
-                package_module = import_module(f".packages.{dep}", package="pmpm")
-            except ImportError as e:
-                raise RuntimeError(f"Package {dep} is not defined in pmpm.packages.{dep}") from e
-            package = package_module.Package(
+        packages = [
+            package_classes[dep](
                 self,
                 update=self.update,
                 fast_update=self.fast_update,
@@ -341,7 +433,24 @@ class InstallEnvironment(metaclass=DocInheritMeta(style="google_with_merge")):
                 tune=self.tune,
                 version=ver,
             )
-            package.run_all()
+            for dep, ver in self.dependencies_versioned.items()
+        ]
+        # compute the properties used by the download threads up front, as cached_property is lock-free
+        self.environ_with_all_paths
+        self.downoad_prefix
+        # download sources in the background while packages are built in order
+        executor = ThreadPoolExecutor(max_workers=self.max_download_workers)
+        try:
+            downloads = [executor.submit(package.download_once) if not package.update else None for package in packages]
+            for package, download in zip(packages, downloads):
+                if download is not None:
+                    download.result()
+                package.run_all()
+        except BaseException:
+            # do not wait for queued downloads that will never be used
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
 
 
 @dataclass
@@ -353,6 +462,8 @@ class CondaOnlyEnvironment(InstallEnvironment):
     environment_variable: ClassVar[tuple[str, ...]] = (
         "CONDA_EXE",  # conda
         "CONDA_PREFIX",  # conda
+        "MAMBA_NO_BANNER",  # mamba
+        "CCACHE_DIR",  # ccache
         "HOME",  # UNIX
         "TERM",  # UNIX
     )
@@ -382,8 +493,10 @@ class CondaOnlyEnvironment(InstallEnvironment):
 
     @cached_property
     def environ(self) -> dict[str, str]:
-        os_env = super().environ
-        _dict = {key: os_env[key] for key in self.environment_variable if key in os_env}
+        # use the shared snapshot directly rather than super().environ to avoid copying all variables
+        os_env = _base_environ()
+        _dict = {key: value for key in self.environment_variable if (value := os_env.get(key)) is not None}
+        _dict.setdefault("CCACHE_DIR", os.fspath(self.ccache_dir))
         for path in self.sanitized_path:
             append_path(_dict, path)
         logger.info("environment constructed as %s", _dict)
@@ -392,20 +505,25 @@ class CondaOnlyEnvironment(InstallEnvironment):
     @cached_property
     def environ_with_all_paths(self) -> dict[str, str]:
         env = self.environ.copy()
-        prepend_path(env, str(self.conda_prefix / "bin"))
+        prepend_path(env, self._conda_prefix_bin)
         return env
 
-    @property
+    @cached_property
     def environ_with_compile_path(self) -> dict[str, str]:
         return self.environ_with_all_paths
 
-    @property
+    @cached_property
     def environ_with_conda_path(self) -> dict[str, str]:
         return self.environ_with_all_paths
 
 
 def cli() -> None:
     """Command line interface for pmpm."""
+    import defopt
+
+    from . import _configure_logging
+
+    _configure_logging()
     env = defopt.run(
         {
             "system_install": InstallEnvironment,
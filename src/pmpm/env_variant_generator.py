@@ -12,10 +12,15 @@ from logging import getLogger
 from pathlib import Path
 from typing import Literal
 
-import defopt
 import yaml
-import yamlloader
 
+try:
+    from yaml import CSafeDumper as SafeDumper
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeDumper, SafeLoader  # type: ignore[assignment]
+
+from . import _configure_logging
 from .util import split_conda_dep_from_pip
 
 logger = getLogger("pmpm")
@@ -41,7 +46,7 @@ def main(
         os: Operating system the environment is for.
     """
     with path.open() as f:
-        env = yaml.load(f, Loader=yamlloader.ordereddict.CSafeLoader)
+        env = yaml.load(f, Loader=SafeLoader)
     conda_dependencies, pip_dependencies = split_conda_dep_from_pip(env["dependencies"])
     # mkl
     if mkl:
@@ -74,14 +79,18 @@ def main(
             f"{mpi}-mpicxx",
             f"{mpi}-mpifort",
         ]
-    conda_dependencies.sort()
+    # deduplicate and sort
+    conda_dependencies = sorted(set(conda_dependencies))
     env["dependencies"] = conda_dependencies + [{"pip": pip_dependencies}] if pip_dependencies else conda_dependencies
     with output.open("w") as f:
-        yaml.dump(env, f, Dumper=yamlloader.ordereddict.CSafeDumper)
+        yaml.dump(env, f, Dumper=SafeDumper, sort_keys=False)
 
 
 def cli() -> None:
     """Command line interface for pmpm."""
+    import defopt
+
+    _configure_logging()
     defopt.run(
         main,
         show_types=True,
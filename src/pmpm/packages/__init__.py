@@ -1,12 +1,13 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import re
+from dataclasses import dataclass, field
 from logging import getLogger
 from typing import TYPE_CHECKING, ClassVar
 
 from custom_inherit import DocInheritMeta
 
-from ..util import run
+from ..util import _subdirs_cached, cached_property, env_flag, native_march, run, which_cached
 
 if TYPE_CHECKING:
     from pathlib import Path
@@ -15,6 +16,9 @@ if TYPE_CHECKING:
 
 logger = getLogger("pmpm")
 
+# git clone --branch only accepts branches and tags
+_COMMIT_SHA = re.compile(r"[0-9a-f]{7,40}")
+
 
 @dataclass
 class GenericPackage(metaclass=DocInheritMeta(style="google_with_merge")):  # type: ignore[misc]
@@ -26,6 +30,7 @@ class GenericPackage(metaclass=DocInheritMeta(style="google_with_merge")):  # ty
         fast_update: whether to use fast update. If True, it will be used if the package
             supports it, otherwise it will fall back to normal update.
         package_name: the name of the package.
+        python_module: the Python module imported by the smoke test.
         arch: the arch to compile for.
         tune: the tune to compile for.
         version: the version to install, which should be a valid git tag/branch for git-based packages.
@@ -35,6 +40,7 @@ class GenericPackage(metaclass=DocInheritMeta(style="google_with_merge")):  # ty
     update: bool | None = None
     fast_update: bool = False
     package_name: ClassVar[str] = ""
+    python_module: ClassVar[str] = ""
     # see doc for march: https://gcc.gnu.org/onlinedocs/gcc/x86-Options.html
     # for example, native or x86-64-v3
     arch: str = "x86-64-v3"
@@ -42,6 +48,7 @@ class GenericPackage(metaclass=DocInheritMeta(style="google_with_merge")):  # ty
     tune: str = "generic"
     # must be a valid git tag/branch for git-based packages
     version: str = "master"
+    downloaded: bool = field(default=False, init=False, repr=False)
 
     def __post_init__(self) -> None:
         # use some heuristics to determine if we need to update or not
@@ -59,6 +66,69 @@ class GenericPackage(metaclass=DocInheritMeta(style="google_with_merge")):  # ty
     def download(self) -> None:
         raise NotImplementedError
 
+    def git_download(self, url: str) -> None:
+        """Partially clone `url` at `version` into `src_dir`, or fetch it if `src_dir` is already a git repository.
+
+        A blobless clone only downloads the files of the checked out commit,
+        but unlike a shallow clone it keeps the history, so that `git describe` and switching versions work.
+        """
+        src_dir = self.src_dir
+        env = self.env.environ_with_all_paths
+        branch = self.version
+        is_commit = branch is not None and _COMMIT_SHA.fullmatch(branch) is not None
+        if (src_dir / ".git").is_dir():
+            logger.info("Found %s, fetching %s instead of cloning...", src_dir, branch or "HEAD")
+            # unlike reset --hard, checkout refuses to discard local changes
+            if is_commit:
+                # remotes do not resolve abbreviated SHAs, so fetch everything and resolve locally
+                run(["git", "fetch", "origin"], env=env, cwd=src_dir)
+                run(["git", "checkout", "--detach", branch], env=env, cwd=src_dir)
+            else:
+                run(["git", "fetch", "origin", branch or "HEAD"], env=env, cwd=src_dir)
+                run(["git", "checkout", "--detach", "FETCH_HEAD"], env=env, cwd=src_dir)
+        else:
+            cmd = ["git", "clone", "--filter=blob:none"]
+            if is_commit:
+                cmd.append("--no-checkout")
+            elif branch is not None:
+                cmd += ["--branch", branch]
+            cmd.append(url)
+            run(cmd, env=env, cwd=src_dir.parent)
+            if is_commit:
+                run(["git", "checkout", "--detach", branch], env=env, cwd=src_dir)
+
+    def download_once(self) -> None:
+        """Download the package unless it has already been downloaded, such as by a prefetch."""
+        if not self.downloaded:
+            self.download()
+            self.downloaded = True
+
+    @property
+    def test_environ(self) -> dict[str, str]:
+        """Environment variables the tests, including the smoke test, run with."""
+        return self.env.environ_with_conda_path
+
+    def _test(self) -> None:
+        raise NotImplementedError
+
+    def run_test(self, smoke: bool = False) -> None:
+        """Run the tests unless skipped.
+
+        :param smoke: only check that the Python module imports instead of running the full test suite,
+            which is also the case if the environment variable `PMPM_SMOKE_TEST` is true.
+        """
+        if self.env.skip_test:
+            return
+        if smoke or env_flag("PMPM_SMOKE_TEST"):
+            logger.info("Running smoke test")
+            self.run_conda_activated(
+                ["python", "-c", f"import {self.python_module}"],
+                env=self.test_environ,
+                cwd=self.env.prefix,
+            )
+        else:
+            self._test()
+
     def install_env(self) -> None:
         raise NotImplementedError
 
@@ -98,17 +168,30 @@ class GenericPackage(metaclass=DocInheritMeta(style="google_with_merge")):  # ty
     @property
     def is_installed(self) -> bool:
         path = self.src_dir
-        is_dir = path.is_dir()
+        # a single scandir of the parent is shared by all packages downloaded there
+        is_dir = path.name in _subdirs_cached(str(path.parent))
         if is_dir:
             logger.info("Found %s, assuming %s has already been installed.", path, self.package_name)
         else:
             logger.info("%s not found, assuming %s not already installed.", path, self.package_name)
         return is_dir
 
-    @property
+    @cached_property
+    def march(self) -> str:
+        """The value of -march, with native resolved to the CPU of this host when the compiler can tell.
+
+        This makes the compile flags, and hence caches keyed on them, differ between hosts.
+        """
+        if self.arch == "native" and (gcc := which_cached("gcc", path=self.env.environ_with_compile_path["PATH"])):
+            if (march := native_march(gcc)) is not None:
+                logger.info("Resolved -march=native to -march=%s", march)
+                return march
+        return self.arch
+
+    @cached_property
     def system(self) -> str:
         return self.env.system
 
-    @property
+    @cached_property
     def sub_platform(self) -> str:
         return self.env.sub_platform
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import hashlib
 from dataclasses import dataclass
 from logging import getLogger
 from typing import TYPE_CHECKING, ClassVar
@@ -22,8 +23,57 @@ class Package(GenericPackage):
     def src_dir(self) -> Path:
         return self.env.conda_prefix / "bin"
 
+    @property
+    def digest_path(self) -> Path:
+        """Path storing the digest of the environment definition last installed/updated."""
+        return self.env.conda_prefix / ".pmpm_env_digest"
+
+    @property
+    def env_digest(self) -> str:
+        """Digest of the parts of the environment definition that conda resolves."""
+        env = self.env
+        spec = repr((env.conda_channels, env.conda_dependencies, env.pip_dependencies))
+        h = hashlib.blake2b(spec.encode())
+        if env.conda_lockfile is not None:
+            h.update(env.conda_lockfile.read_bytes())
+        return h.hexdigest()
+
+    def _write_digest(self) -> None:
+        self.digest_path.write_text(self.env_digest)
+
+    def _run_lockfile(self, subcommand: str) -> None:
+        """Install packages from the explicit lockfile without solving.
+
+        :param subcommand: create or install.
+        """
+        cmd = [
+            str(self.env.mamba_bin),
+            subcommand,
+            "--yes",
+            "--prefix",
+            str(self.env.conda_prefix),
+            "--file",
+            str(self.env.conda_lockfile),
+        ]
+        run(
+            cmd,
+            env=self.env.environ_with_conda_path,
+        )
+        if pip_dependencies := self.env.pip_dependencies:
+            logger.info("Installing pip dependencies")
+            self.run_conda_activated(
+                ["python", "-m", "pip", "install", *pip_dependencies],
+                env=self.env.environ_with_conda_path,
+            )
+        self._write_digest()
+
     def _install_conda(self) -> None:
+        if (self.env.conda_prefix / "conda-meta").is_dir():
+            logger.info("Conda environment already exists at %s, updating instead.", self.env.conda_prefix)
+            return self.update_env()
         logger.info("Creating conda environment")
+        if self.env.conda_lockfile is not None:
+            return self._run_lockfile("create")
         cmd = [
             str(self.env.mamba_bin),
             "env",
@@ -37,6 +87,7 @@ class Package(GenericPackage):
             cmd,
             env=self.env.environ_with_conda_path,
         )
+        self._write_digest()
 
     def _install_ipykernel(self) -> None:
         logger.info("Registering ipykernel")
@@ -63,6 +114,8 @@ class Package(GenericPackage):
 
     def update_env(self) -> None:
         logger.info("Updating conda environment")
+        if self.env.conda_lockfile is not None:
+            return self._run_lockfile("install")
         cmd = [
             str(self.env.mamba_bin),
             "env",
@@ -76,3 +129,14 @@ class Package(GenericPackage):
             cmd,
             env=self.env.environ_with_conda_path,
         )
+        self._write_digest()
+
+    def update_env_fast(self) -> None:
+        try:
+            unchanged = self.digest_path.read_text() == self.env_digest
+        except FileNotFoundError:
+            unchanged = False
+        if unchanged:
+            logger.info("Conda channels and dependencies unchanged since last install/update, skip updating.")
+        else:
+            self.update_env()
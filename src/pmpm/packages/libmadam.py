@@ -1,21 +1,22 @@
 from __future__ import annotations
 
+import hashlib
+import os
 from dataclasses import dataclass
 from logging import getLogger
-from typing import TYPE_CHECKING, ClassVar
+from pathlib import Path
+from typing import ClassVar
 
-from ..util import run
+from ..util import cached_property, run
 from . import GenericPackage
 
 logger = getLogger("pmpm")
 
-if TYPE_CHECKING:
-    from pathlib import Path
-
 
 @dataclass
 class Package(GenericPackage):
     package_name: ClassVar[str] = "libmadam"
+    python_module: ClassVar[str] = "libmadam_wrapper"
 
     @property
     def src_dir(self) -> Path:
@@ -23,30 +24,73 @@ class Package(GenericPackage):
 
     def download(self) -> None:
         logger.info("Downloading %s", self.package_name)
-        cmd = [
-            "git",
-            "clone",
-            f"https://github.com/hpc4cmb/{self.package_name}.git",
+        self.git_download(f"https://github.com/hpc4cmb/{self.package_name}.git")
+
+    def _makefile_ams(self) -> list[Path]:
+        """Every Makefile.am in `src_dir`, without walking into .git."""
+        paths: list[Path] = []
+        for root, dirs, files in os.walk(self.src_dir):
+            dirs[:] = [d for d in dirs if d != ".git"]
+            if "Makefile.am" in files:
+                paths.append(Path(root) / "Makefile.am")
+        return paths
+
+    @staticmethod
+    def _is_stale(outputs: list[Path], inputs: list[Path]) -> bool:
+        """Whether any of `outputs` is missing or older than any existing path in `inputs`."""
+        try:
+            generated = min(path.stat().st_mtime_ns for path in outputs)
+        except FileNotFoundError:
+            return True
+        return any(path.stat().st_mtime_ns > generated for path in inputs if path.exists())
+
+    def _needs_reconfigure(self) -> bool:
+        """Whether config.status is stale.
+
+        The configure script regenerated by autogen and the environment definition,
+        which holds the arch and tune flags, are inputs too.
+        A config.status from a fresh install, which disables dependency tracking, is stale too,
+        as updates need it to rebuild after header changes.
+        """
+        src_dir = self.src_dir
+        config_status = src_dir / "config.status"
+        inputs = [
+            src_dir / "configure",
+            src_dir / "configure.ac",
+            self.env.conda_environment_path,
+            *self._makefile_ams(),
         ]
-        run(
-            cmd,
-            env=self.env.environ_with_all_paths,
-            cwd=self.src_dir.parent,
-        )
-        if (branch := self.version) is not None:
-            logger.info("Changing to %s branch...", branch)
-            cmd = [
-                "git",
-                "checkout",
-                branch,
-            ]
-            run(
-                cmd,
-                env=self.env.environ_with_all_paths,
-                cwd=self.src_dir,
-            )
+        if self._is_stale([config_status], inputs):
+            return True
+        # the flags can change without touching any file, such as when -march=native resolves to another host
+        try:
+            if self.configure_digest_path.read_text() != self.configure_digest:
+                return True
+        except FileNotFoundError:
+            return True
+        return "--disable-dependency-tracking" in config_status.read_text()
+
+    def _needs_autogen(self) -> bool:
+        """Whether configure or any Makefile.in is missing or older than the inputs of autogen.
+
+        Checking every Makefile.in catches an interrupted autogen that already wrote configure.
+        """
+        src_dir = self.src_dir
+        makefile_ams = self._makefile_ams()
+        inputs = [
+            src_dir / "autogen.sh",
+            src_dir / "configure.ac",
+            src_dir / "acinclude.m4",
+            *(src_dir / "m4").glob("*.m4"),
+            *makefile_ams,
+        ]
+        outputs = [src_dir / "configure", *(path.with_suffix(".in") for path in makefile_ams)]
+        return self._is_stale(outputs, inputs)
 
     def _autogen(self) -> None:
+        if not self._needs_autogen():
+            logger.info("%s is up-to-date, skipping autogen.", self.src_dir / "configure")
+            return
         logger.info("Running autogen")
         self.run_conda_activated(
             "./autogen.sh",
@@ -54,17 +98,32 @@ class Package(GenericPackage):
             cwd=self.src_dir,
         )
 
-    def _configure(self) -> None:
-        env = self.env.environ_with_compile_path.copy()
-        env["MPIFC"] = "mpifort"
-        env["FC"] = "mpifort"
-
+    @cached_property
+    def compile_flags(self) -> str:
+        """The CFLAGS and FCFLAGS passed to configure."""
         inc = self.env.compile_prefix / "include"
         lib = self.env.compile_prefix / "lib"
-        temp = f'-O3 -fPIC -pthread -march={self.arch} -mtune={self.tune} -I"{inc}" -L"{lib}"'
+        temp = f'-O3 -fPIC -pthread -march={self.march} -mtune={self.tune} -I"{inc}" -L"{lib}"'
         if self.env.is_darwin:
             temp += " -I/Library/Developer/CommandLineTools/SDKs/MacOSX.sdk/usr/include -L/Library/Developer/CommandLineTools/SDKs/MacOSX.sdk/usr/lib"
+        return temp
 
+    @property
+    def configure_digest_path(self) -> Path:
+        """Path storing the digest of the flags configure last ran with."""
+        return self.src_dir / ".pmpm_configure_digest"
+
+    @property
+    def configure_digest(self) -> str:
+        """Digest of the flags passed to configure."""
+        return hashlib.blake2b(repr((self.compile_flags, str(self.env.compile_prefix))).encode()).hexdigest()
+
+    def _configure(self) -> None:
+        env = self.env.environ_with_compile_path.copy()
+        env["MPIFC"] = "mpifort"
+        env["FC"] = "mpifort"
+
+        temp = self.compile_flags
         env["FCFLAGS"] = temp
         env["CFLAGS"] = temp
         logger.info("Running configure with environment %s", env)
@@ -73,35 +132,31 @@ class Package(GenericPackage):
             "./configure",
             f"--prefix={self.env.compile_prefix}",
         ]
+        # dependency tracking only pays off when rebuilding after edits
+        if not self.update:
+            cmd.append("--disable-dependency-tracking")
 
         self.run_conda_activated(
             cmd,
             env=env,
             cwd=self.src_dir,
         )
-
-    def _make(self) -> None:
-        logger.info("Running make")
-        cmd = [
-            "make",
-            f"-j{self.env.cpu_count}",
-        ]
-        run(
-            cmd,
-            env=self.env.environ_with_compile_path,
-            cwd=self.src_dir,
-        )
+        self.configure_digest_path.write_text(self.configure_digest)
 
     def _make_install(self) -> None:
+        # automake's install target depends on all, so this builds and installs in one make invocation
         logger.info("Running make install")
+        env = self.env.environ_with_compile_path
         cmd = [
             "make",
             "install",
-            f"-j{self.env.cpu_count}",
         ]
+        # make reads the job count from MAKEFLAGS when set by the user
+        if "MAKEFLAGS" not in env:
+            cmd.append(f"-j{self.env.cpu_count}")
         run(
             cmd,
-            env=self.env.environ_with_compile_path,
+            env=env,
             cwd=self.src_dir,
         )
 
@@ -109,8 +164,12 @@ class Package(GenericPackage):
         logger.info("Running Python install")
         cmd = [
             "python",
-            "setup.py",
+            "-m",
+            "pip",
             "install",
+            "--no-build-isolation",
+            "--no-deps",
+            ".",
         ]
         self.run_conda_activated(
             cmd,
@@ -127,35 +186,32 @@ class Package(GenericPackage):
         ]
         self.run_conda_activated(
             cmd,
-            env=self.env.environ_with_conda_path,
+            env=self.test_environ,
             cwd=self.src_dir / "python",
         )
 
     def install_env(self) -> None:
         logger.info("Installing %s", self.package_name)
-        self.download()
+        self.download_once()
         self._autogen()
         self._configure()
-        self._make()
         self._make_install()
         self._python_install()
-        if not self.env.skip_test:
-            self._test()
+        self.run_test()
 
     def update_env(self) -> None:
         logger.info("Updating %s, any changes in %s will be installed.", self.package_name, self.src_dir)
-        self._autogen()
-        self._configure()
-        self._make()
+        if self._needs_reconfigure():
+            self._autogen()
+            self._configure()
+        else:
+            logger.info("%s is up-to-date, skipping autogen and configure.", self.src_dir / "config.status")
         self._make_install()
         self._python_install()
-        if not self.env.skip_test:
-            self._test()
+        self.run_test()
 
     def update_env_fast(self) -> None:
         logger.info("Fast updating %s, any changes in %s will be installed.", self.package_name, self.src_dir)
-        self._make()
         self._make_install()
         self._python_install()
-        if not self.env.skip_test:
-            self._test()
+        self.run_test(smoke=True)
@@ -1,14 +1,13 @@
 from __future__ import annotations
 
+import hashlib
 import os
-import tempfile
+import shutil
 from dataclasses import dataclass
-from functools import cached_property
 from logging import getLogger
-from shutil import which
 from typing import TYPE_CHECKING, ClassVar
 
-from ..util import run
+from ..util import cached_property, is_gcc, run, which_cached
 from . import GenericPackage
 
 logger = getLogger("pmpm")
@@ -20,6 +19,15 @@ if TYPE_CHECKING:
 @dataclass
 class Package(GenericPackage):
     package_name: ClassVar[str] = "toast"
+    python_module: ClassVar[str] = "toast"
+    # optional cache entries passed by pmpm, which must be absent from the cache when not passed
+    optional_cmake_keys: ClassVar[tuple[str, ...]] = (
+        "CMAKE_INTERPROCEDURAL_OPTIMIZATION",
+        "CMAKE_C_COMPILER_LAUNCHER",
+        "CMAKE_CXX_COMPILER_LAUNCHER",
+        "MPI_C_COMPILER",
+        "MPI_CXX_COMPILER",
+    )
 
     @property
     def src_dir(self) -> Path:
@@ -31,49 +39,42 @@ class Package(GenericPackage):
         path.mkdir(parents=True, exist_ok=True)
         return path
 
+    @cached_property
+    def use_ninja(self) -> bool:
+        """Whether to use the Ninja generator.
+
+        An existing build directory configured by another generator is kept as is,
+        as CMake refuses to switch generators in place.
+        """
+        generator = self._read_cmake_cache().get("CMAKE_GENERATOR")
+        if generator is not None:
+            return generator == "Ninja"
+        return which_cached("ninja", path=self.env.environ_with_compile_path["PATH"]) is not None
+
     def download(self) -> None:
         logger.info("Downloading %s", self.package_name)
-        cmd = [
-            "git",
-            "clone",
-            f"https://github.com/hpc4cmb/{self.package_name}.git",
-        ]
-        run(
-            cmd,
-            env=self.env.environ_with_all_paths,
-            cwd=self.src_dir.parent,
-        )
-        if (branch := self.version) is not None:
-            logger.info("Changing to %s branch...", branch)
-            cmd = [
-                "git",
-                "checkout",
-                branch,
-            ]
-            run(
-                cmd,
-                env=self.env.environ_with_all_paths,
-                cwd=self.src_dir,
-            )
+        self.git_download(f"https://github.com/hpc4cmb/{self.package_name}.git")
 
-    def _cmake(self) -> None:
-        logger.info("Running CMake")
-        prefix = self.env.compile_prefix
-        libext = "dylib" if self.env.is_darwin else "so"
+    @property
+    def pgo_dir(self) -> Path:
+        """Directory of the profiles for profile-guided optimization."""
+        return self.build_dir / "pgo"
 
-        # compilers discovery
+    @cached_property
+    def compilers(self) -> tuple[str, str, str | None, str | None]:
+        """The C and C++ compilers, and the MPI compiler wrappers if found, as (CC, CXX, MPICC, MPICXX)."""
         env = self.env.environ_with_compile_path
         PATH = env["PATH"]
         # CC
-        MPICC: str | None = which("mpicc", path=PATH)
+        MPICC: str | None = which_cached("mpicc", path=PATH)
         CC: str
         if MPICC is not None:
             logger.info("Using MPICC=%s", MPICC)
             CC = MPICC
         else:
-            _CC: str | None = which("gcc", path=PATH)
+            _CC: str | None = which_cached("gcc", path=PATH)
             if _CC is None:
-                _CC = which("clang", path=PATH)
+                _CC = which_cached("clang", path=PATH)
             if _CC is None:
                 raise RuntimeError("Could not find a C compiler")
             else:
@@ -81,30 +82,87 @@ class Package(GenericPackage):
                 CC = _CC
             del _CC
         # CXX
-        MPICXX: str | None = which("mpicxx", path=PATH)
+        MPICXX: str | None = which_cached("mpicxx", path=PATH)
         CXX: str
         if MPICXX is not None:
             logger.info("Using MPICXX=%s", MPICXX)
             CXX = MPICXX
         else:
-            _CXX = which("g++", path=PATH)
+            _CXX = which_cached("g++", path=PATH)
             if _CXX is None:
-                _CXX = which("clang++", path=PATH)
+                _CXX = which_cached("clang++", path=PATH)
             if _CXX is None:
                 raise RuntimeError("Could not find a C++ compiler")
             else:
                 logger.info("Using CXX=%s", _CXX)
                 CXX = _CXX
             del _CXX
+        return CC, CXX, MPICC, MPICXX
+
+    def _read_cmake_cache(self) -> dict[str, str]:
+        """The entries of CMakeCache.txt in the build directory, empty if it does not exist."""
+        cache: dict[str, str] = {}
+        try:
+            with (self.build_dir / "CMakeCache.txt").open() as f:
+                for line in f:
+                    if line.startswith(("#", "//")):
+                        continue
+                    key, sep, value = line.rstrip("\n").partition("=")
+                    if sep:
+                        # strip the type in KEY:TYPE
+                        cache[key.partition(":")[0]] = value
+        except FileNotFoundError:
+            pass
+        return cache
+
+    def _cmake_cache_matches(self, cmd: list[str]) -> bool:
+        """Whether every -D and -G argument of `cmd` has the same value in CMakeCache.txt.
+
+        This catches arguments that are only reordered, which changes the digest of `cmd`.
+        Entries of `optional_cmake_keys` not in `cmd` must also be absent from the cache,
+        such that turning off LTO, ccache or MPI reconfigures.
+        """
+        cache = self._read_cmake_cache()
+        passed: set[str] = set()
+        for arg in cmd:
+            if arg.startswith("-D"):
+                key, _, value = arg[2:].partition("=")
+                key = key.partition(":")[0]
+            elif arg.startswith("-G"):
+                key, value = "CMAKE_GENERATOR", arg[2:]
+            else:
+                continue
+            if cache.get(key) != value:
+                return False
+            passed.add(key)
+        return not any(key in cache for key in self.optional_cmake_keys if key not in passed)
+
+    def _cmake(self, pgo: str | None = None) -> None:
+        """Run CMake.
+
+        :param pgo: either generate or use, for the two passes of profile-guided optimization.
+        """
+        logger.info("Running CMake")
+        prefix = self.env.compile_prefix
+        libext = "dylib" if self.env.is_darwin else "so"
+        flags = f"-O3 -fPIC -pthread -march={self.march} -mtune={self.tune}"
+        if pgo == "generate":
+            flags += f" -fprofile-generate={self.pgo_dir}"
+        elif pgo == "use":
+            flags += f" -fprofile-use={self.pgo_dir} -fprofile-correction -Wno-error=coverage-mismatch"
+
+        env = self.env.environ_with_compile_path
+        PATH = env["PATH"]
+        CC, CXX, MPICC, MPICXX = self.compilers
         cmd = [
             "cmake",
             "-DCMAKE_VERBOSE_MAKEFILE:BOOL=ON",
             "-DPython3_FIND_VIRTUALENV=ONLY",
             f"-DBLAS_LIBRARIES={prefix}/lib/libblas.{libext}",
             f"-DCMAKE_C_COMPILER={CC}",
-            f"-DCMAKE_C_FLAGS=-O3 -fPIC -pthread -march={self.arch} -mtune={self.tune}",
+            f"-DCMAKE_C_FLAGS={flags}",
             f"-DCMAKE_CXX_COMPILER={CXX}",
-            f"-DCMAKE_CXX_FLAGS=-O3 -fPIC -pthread -march={self.arch} -mtune={self.tune}",
+            f"-DCMAKE_CXX_FLAGS={flags}",
             f"-DCMAKE_INSTALL_PREFIX={prefix}",
             f"-DFFTW_ROOT={prefix}",
             f"-DLAPACK_LIBRARIES={prefix}/lib/liblapack.{libext}",
@@ -120,78 +178,130 @@ class Package(GenericPackage):
             cmd.append(f"-DMPI_C_COMPILER={MPICC}")
         if MPICXX is not None:
             cmd.append(f"-DMPI_CXX_COMPILER={MPICXX}")
-        run(
-            cmd,
-            env=self.env.environ_with_compile_path,
-            cwd=self.build_dir,
+        if self.use_ninja:
+            cmd.append("-GNinja")
+        # let CMake pick the LTO flags supported by the compiler
+        if self.env.lto:
+            cmd.append("-DCMAKE_INTERPROCEDURAL_OPTIMIZATION:BOOL=ON")
+        # serve unchanged translation units from cache on rebuilds
+        if which_cached("ccache", path=PATH) is not None:
+            logger.info("Using ccache as compiler launcher with CCACHE_DIR=%s", env["CCACHE_DIR"])
+            cmd += [
+                "-DCMAKE_C_COMPILER_LAUNCHER=ccache",
+                "-DCMAKE_CXX_COMPILER_LAUNCHER=ccache",
+            ]
+        # skip reconfiguring, which reruns every find_package, if the arguments are unchanged
+        build_dir = self.build_dir
+        digest = hashlib.blake2b(repr(cmd).encode()).hexdigest()
+        digest_path = build_dir / ".pmpm_cmake_digest"
+        # a failed configure still writes CMakeCache.txt, but not the build system
+        configured = (build_dir / "CMakeCache.txt").is_file() and (
+            (build_dir / "build.ninja").is_file() or (build_dir / "Makefile").is_file()
         )
-
-    def _make(self) -> None:
-        logger.info("Running Make")
-        cmd = [
-            "make",
-            f"-j{self.env.cpu_count}",
-        ]
+        if configured:
+            try:
+                unchanged = digest_path.read_text() == digest
+            except FileNotFoundError:
+                unchanged = False
+            if unchanged or self._cmake_cache_matches(cmd):
+                logger.info("CMake cache in %s is up-to-date, skipping CMake.", build_dir)
+                digest_path.write_text(digest)
+                return
+        # only a successful configure writes the digest back
+        digest_path.unlink(missing_ok=True)
         run(
             cmd,
             env=self.env.environ_with_compile_path,
-            cwd=self.build_dir,
+            cwd=build_dir,
         )
+        digest_path.write_text(digest)
 
-    def _make_install(self) -> None:
-        logger.info("Running make install")
+    def _build_install(self) -> None:
+        logger.info("Running CMake build and install")
+        env = self.env.environ_with_compile_path
         cmd = [
-            "make",
+            "cmake",
+            "--build",
+            str(self.build_dir),
+            "--target",
             "install",
-            f"-j{self.env.cpu_count}",
         ]
+        # CMake reads the job count from CMAKE_BUILD_PARALLEL_LEVEL when set by the user
+        if "CMAKE_BUILD_PARALLEL_LEVEL" not in env:
+            cmd += ["--parallel", str(self.env.cpu_count)]
         run(
             cmd,
-            env=self.env.environ_with_compile_path,
+            env=env,
             cwd=self.build_dir,
         )
 
+    def _build_install_pgo(self) -> None:
+        """Build with profile-guided optimization, using the test suite as the training run.
+
+        Only GCC is supported, otherwise it falls back to a normal build with a warning.
+        """
+        CC = self.compilers[0]
+        if not is_gcc(CC):
+            logger.warning("Profile-guided optimization requires GCC but %s is not, building without it.", CC)
+            self._cmake()
+            self._build_install()
+            return
+        logger.info("Building %s with profile-guided optimization", self.package_name)
+        shutil.rmtree(self.pgo_dir, ignore_errors=True)
+        self._cmake(pgo="generate")
+        self._build_install()
+        self._test()
+        self._cmake(pgo="use")
+        self._build_install()
+
+    @property
+    def test_environ(self) -> dict[str, str]:
+        return self.env.environ_with_all_paths
+
     def _test(self) -> None:
         logger.info("Running test")
         CIBUILDWHEEL = os.environ.get("CIBUILDWHEEL", None)
         if CIBUILDWHEEL is not None:
-            env = self.env.environ_with_all_paths.copy()
+            env = self.test_environ.copy()
             logger.info("Skipping toast timing test by setting CIBUILDWHEEL=%s", CIBUILDWHEEL)
             env["CIBUILDWHEEL"] = CIBUILDWHEEL
         else:
-            env = self.env.environ_with_all_paths
+            env = self.test_environ
         cmd = [
             "python",
             "-c",
             "from toast.tests import run; run()",
         ]
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            self.run_conda_activated(
-                cmd,
-                env=env,
-                cwd=tmpdirname,
-            )
+        # a scratch directory kept after the run, so that test outputs can be inspected
+        scratch_dir = self.build_dir / "test_scratch"
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        scratch_dir.mkdir()
+        self.run_conda_activated(
+            cmd,
+            env=env,
+            cwd=scratch_dir,
+        )
 
     def install_env(self) -> None:
         logger.info("Installing %s", self.package_name)
-        self.download()
-        self._cmake()
-        self._make()
-        self._make_install()
-        if not self.env.skip_test:
-            self._test()
+        self.download_once()
+        if self.env.pgo:
+            self._build_install_pgo()
+        else:
+            self._cmake()
+            self._build_install()
+        self.run_test()
 
     def update_env(self) -> None:
         logger.info("Updating %s, any changes in %s will be installed.", self.package_name, self.src_dir)
-        self._cmake()
-        self._make()
-        self._make_install()
-        if not self.env.skip_test:
-            self._test()
+        if self.env.pgo:
+            self._build_install_pgo()
+        else:
+            self._cmake()
+            self._build_install()
+        self.run_test()
 
     def update_env_fast(self) -> None:
         logger.info("Fast updating %s, any changes in %s will be installed.", self.package_name, self.src_dir)
-        self._make()
-        self._make_install()
-        if not self.env.skip_test:
-            self._test()
+        self._build_install()
+        self.run_test(smoke=True)
@@ -1,62 +1,257 @@
 from __future__ import annotations
 
 import os
+import shlex
 import subprocess
-from logging import getLogger
+import sys
+from functools import lru_cache
+from logging import INFO, NOTSET, getLogger
 from pathlib import Path
+from shutil import which
+from typing import Any, Callable, Generic, TypeVar, overload
 
 logger = getLogger(__name__)
 
+T = TypeVar("T")
+
+
+class cached_property(Generic[T]):
+    """A lock-free replacement of `functools.cached_property`.
+
+    Before Python 3.12, `functools.cached_property` acquires a lock on first access.
+    Without it, concurrent first accesses may each compute the value and the last one wins,
+    so properties shared with worker threads should be accessed once before the threads start.
+    """
+
+    def __init__(self, func: Callable[[Any], T]) -> None:
+        self.func = func
+        self.attrname: str = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        self.attrname = name
+
+    @overload
+    def __get__(self, instance: None, owner: type | None = None) -> cached_property[T]:
+        ...
+
+    @overload
+    def __get__(self, instance: object, owner: type | None = None) -> T:
+        ...
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.attrname] = self.func(instance)
+        return value
+
 
 def prepend_path(environ: dict[str, str], path: str) -> None:
     """Prepend to PATH in environment dictionary in-place."""
-    if "PATH" in environ:
-        environ["PATH"] = path + os.pathsep + environ["PATH"]
-    else:
-        environ["PATH"] = path
+    existing = environ.get("PATH")
+    environ["PATH"] = f"{path}{os.pathsep}{existing}" if existing else path
 
 
 def append_path(environ: dict[str, str], path: str) -> None:
     """Append to PATH in environment dictionary in-place."""
-    if "PATH" in environ:
-        environ["PATH"] += os.pathsep + path
-    else:
-        environ["PATH"] = path
+    existing = environ.get("PATH")
+    environ["PATH"] = f"{existing}{os.pathsep}{path}" if existing else path
 
 
-def append_env(dependencies: list[str], package: str) -> None:
-    """Append a package to conda environment definition."""
-    if package not in dependencies:
+def append_env(dependencies: list[str], seen: set[str], package: str) -> None:
+    """Append a package to conda environment definition.
+
+    :param seen: the set of packages already in `dependencies`, updated in-place.
+        It is used for O(1) membership test.
+    """
+    if package not in seen:
+        seen.add(package)
         dependencies.append(package)
 
 
+@lru_cache(maxsize=256)
+def _is_file_cached(path: str) -> bool:
+    return Path(path).is_file()
+
+
+@lru_cache(maxsize=256)
+def _is_dir_cached(path: str) -> bool:
+    return Path(path).is_dir()
+
+
+@lru_cache(maxsize=32)
+def _subdirs_cached(path: str) -> frozenset[str]:
+    """Return the names of the subdirectories of `path`, or an empty set if it does not exist."""
+    try:
+        with os.scandir(path) as it:
+            return frozenset(entry.name for entry in it if entry.is_dir())
+    except FileNotFoundError:
+        return frozenset()
+
+
+@lru_cache(maxsize=32)
+def which_cached(cmd: str, path: str | None = None) -> str | None:
+    """Cached `shutil.which`, see `_invalidate_stat_cache`."""
+    return which(cmd, path=path)
+
+
+def _invalidate_stat_cache() -> None:
+    """Clear the cache used by `check_file`, `check_dir`, `which_cached` and `is_installed`."""
+    _is_file_cached.cache_clear()
+    _is_dir_cached.cache_clear()
+    _subdirs_cached.cache_clear()
+    which_cached.cache_clear()
+
+
+@lru_cache(maxsize=1)
+def physical_cpu_count() -> int | None:
+    """Return the number of physical CPU cores, or None if it cannot be determined."""
+    if sys.platform == "darwin":
+        try:
+            res = subprocess.run(["sysctl", "-n", "hw.physicalcpu"], capture_output=True, check=True, text=True)
+            return int(res.stdout)
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            return None
+    # only count the CPUs this process may run on, e.g. under taskset or a cpuset
+    allowed = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else None
+    # on Linux, logical CPUs sharing a physical core have the same list of siblings
+    cores: set[str] = set()
+    for cpu in Path("/sys/devices/system/cpu").glob("cpu[0-9]*"):
+        if allowed is not None and int(cpu.name[3:]) not in allowed:
+            continue
+        for name in ("core_cpus_list", "thread_siblings_list"):
+            try:
+                cores.add((cpu / "topology" / name).read_text().strip())
+                break
+            except OSError:
+                continue
+    return len(cores) or None
+
+
+@lru_cache(maxsize=8)
+def native_march(compiler: str) -> str | None:
+    """Return the CPU that `-march=native` resolves to for a GCC-compatible `compiler`, or None if unknown.
+
+    :param compiler: path to the compiler, such as gcc.
+    """
+    try:
+        res = subprocess.run(
+            [compiler, "-march=native", "-Q", "--help=target"],
+            capture_output=True,
+            check=True,
+            text=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    for line in res.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == "-march=" and parts[1] != "native":
+            return parts[1]
+    return None
+
+
+@lru_cache(maxsize=8)
+def is_gcc(compiler: str) -> bool:
+    """Return whether `compiler`, possibly an MPI wrapper, is GCC rather than another compiler such as clang.
+
+    :param compiler: path to the compiler.
+    """
+    try:
+        res = subprocess.run([compiler, "--version"], capture_output=True, check=True, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    version = res.stdout.lower()
+    return "clang" not in version and ("gcc" in version or "free software foundation" in version)
+
+
+@lru_cache(maxsize=1)
+def cgroup_cpu_quota() -> int | None:
+    """Return the CPU quota of the cgroup of this process rounded up, or None if unlimited or unknown."""
+    cgroup = Path("/sys/fs/cgroup")
+    try:
+        # cgroup v2
+        quota, period = (cgroup / "cpu.max").read_text().split()
+    except (OSError, ValueError):
+        try:
+            # cgroup v1
+            quota = (cgroup / "cpu" / "cpu.cfs_quota_us").read_text()
+            period = (cgroup / "cpu" / "cpu.cfs_period_us").read_text()
+        except OSError:
+            return None
+    try:
+        quota_int, period_int = int(quota), int(period)
+    except ValueError:
+        # "max" in cgroup v2
+        return None
+    if quota_int <= 0 or period_int <= 0:
+        # -1 in cgroup v1
+        return None
+    return -(-quota_int // period_int)
+
+
 def check_file(path: Path, msg: str) -> None:
-    """Check if a file exists."""
-    if path.is_file():
+    """Check if a file exists.
+
+    The result is cached, see `_invalidate_stat_cache`.
+    """
+    if _is_file_cached(str(path)):
         logger.info(msg, path)
     else:
         raise RuntimeError(f"{path} not found.")
 
 
 def check_dir(path: Path, msg: str) -> None:
-    """Check if a directory exists."""
-    if path.is_dir():
+    """Check if a directory exists.
+
+    The result is cached, see `_invalidate_stat_cache`.
+    """
+    if _is_dir_cached(str(path)):
         logger.info(msg, path)
     else:
         raise RuntimeError(f"{path} not found.")
 
 
+def env_flag(name: str) -> bool:
+    """Return whether the environment variable `name` is set to a true value such as 1, true, yes or on."""
+    return os.environ.get(name, "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def _explicitly_quiet() -> bool:
+    """Whether a pmpm logger has its own level set above INFO.
+
+    A level inherited from the root logger, as in library use without `PMPMLOGLEVEL`, does not count.
+    """
+    current = logger
+    while current.parent is not None:
+        if current.level != NOTSET:
+            return current.level > INFO
+        current = current.parent
+    return False
+
+
 def run(
     command: str | list[str],
     **kwargs,
 ) -> None:
     """Run command while logging what is running.
 
+    Unless `PMPM_VERBOSE` is true, stdout is discarded when the pmpm logger is explicitly set above INFO,
+    such as via `PMPMLOGLEVEL`, while stderr is kept so that failures can still be diagnosed.
+    stdin is closed by default as the commands are non-interactive.
+
     :param command: can be in string or list of string that subprocess.run accepts.
     :param kwargs: passes to subprocess.run
     """
-    cmd_str = subprocess.list2cmdline(command)
-    logger.info("Running %s", cmd_str)
+    if logger.isEnabledFor(INFO):
+        logger.info("Running %s", command if isinstance(command, str) else shlex.join(command))
+    elif (
+        "stdout" not in kwargs
+        and "capture_output" not in kwargs
+        and not env_flag("PMPM_VERBOSE")
+        and _explicitly_quiet()
+    ):
+        kwargs["stdout"] = subprocess.DEVNULL
+    kwargs.setdefault("stdin", subprocess.DEVNULL)
     subprocess.run(
         command,
         check=True,